@@ -1,18 +1,40 @@
 import argparse
+import functools
+import io
 import json
+import math
+import mmap
+import os
+import textwrap
+from multiprocessing import Pool
 from pathlib import Path
 from pdf2image import convert_from_path
 from pdfminer.layout import LAParams
 from pdfminer.pdfparser import PDFParser
 from pdfminer.pdfdocument import PDFDocument
 from pdfminer.pdfpage import PDFPage
+from pdfminer.pdfinterp import LITERAL_FORM, LITERAL_IMAGE, PDFContentParser
 from pdfminer.pdfinterp import PDFResourceManager, PDFPageInterpreter
 from pdfminer.converter import PDFPageAggregator
-from pdfminer.layout import LAParams, LTTextBox, LTFigure
+from pdfminer.layout import LAParams, LTTextBox, LTFigure, LTImage
+from pdfminer.pdfcolor import LITERAL_DEVICE_CMYK
+from pdfminer.pdftypes import LITERALS_DCT_DECODE, PDFObjRef, PDFStream, dict_value, resolve1
+from pdfminer.psparser import PSEOF, PSKeyword, PSLiteral, keyword_name, literal_name
 import pymupdf
 from sklearn.cluster import DBSCAN
 
 
+IMAGE_BUFFER_SIZE = 1 << 20
+
+# Layout analysis settings. "fast" skips pdfminer's hierarchical grouping and
+# ordering of text boxes (boxes_flow=None), elements are re-sorted by
+# sort_bounding_boxes anyway
+LAPARAMS_PROFILES = {
+    "fast": LAParams(boxes_flow=None),
+    "default": LAParams(),
+}
+
+
 # Function to combine bounding boxes
 def combine_bounding_boxes(bounding_boxes):
     x0 = min(box[0] for box in bounding_boxes)
@@ -57,6 +79,84 @@ def cluster_figures(elements, eps=300):
     return figures
 
 
+# Function to check if two bounding boxes share some area
+def boxes_overlap(box, other):
+    return box[0] < other[2] and other[0] < box[2] and box[1] < other[3] and other[1] < box[3]
+
+
+# Function to get the embedded JPEG payload of a figure made of a single image
+# that the JPEG renders as is: unmasked, undecoded, placed upright and with
+# nothing else on the page (text, paths, figures, tables) drawn over it
+def get_jpeg_data(figure, other_bboxes, tolerance=1):
+    if len(figure.elements) != 1 or len(figure.elements[0]) != 1:
+        return None
+    a, b, c, d, _, _ = figure.elements[0].matrix
+    if b != 0 or c != 0 or a <= 0 or d <= 0:
+        return None
+    if any(boxes_overlap(figure.bbox, bbox) for bbox in other_bboxes):
+        return None
+    image = next(iter(figure.elements[0]))
+    if not isinstance(image, LTImage) or LITERAL_DEVICE_CMYK in image.colorspace:
+        return None
+    if any(image.stream.get(key) is not None for key in ("SMask", "Mask", "Decode", "ImageMask")):
+        return None
+    if any(abs(a - b) > tolerance for a, b in zip(image.bbox, figure.bbox)):
+        return None
+    filters = image.stream.get_filters()
+    if len(filters) != 1 or filters[0][0] not in LITERALS_DCT_DECODE:
+        return None
+    return image.stream.get_rawdata()
+
+
+# Function to detect scanned pages, whose content stream draws images but (almost)
+# no text. Pages drawing a Form XObject are never scans, their text may be inside it
+def is_scanned_page(page, min_text_ops=5):
+    xobjects = dict_value(page.resources.get("XObject", {})) if page.resources else {}
+    try:
+        parser = PDFContentParser([resolve1(stream) for stream in page.contents])
+    except PSEOF:
+        # empty page
+        return False
+
+    text_ops = image_ops = 0
+    operands = []
+    while True:
+        try:
+            (_, obj) = parser.nextobject()
+        except PSEOF:
+            break
+        if not isinstance(obj, PSKeyword):
+            operands.append(obj)
+            continue
+
+        name = keyword_name(obj)
+        if name in ("Tj", "TJ", "'", '"'):
+            text_ops += 1
+        elif name == "EI":
+            # inline image
+            image_ops += 1
+        elif name == "Do" and operands and isinstance(operands[-1], PSLiteral):
+            xobject = resolve1(xobjects.get(literal_name(operands[-1])))
+            subtype = xobject.get("Subtype") if isinstance(xobject, PDFStream) else None
+            if subtype is LITERAL_FORM:
+                return False
+            if subtype is LITERAL_IMAGE:
+                image_ops += 1
+        operands = []
+
+    return text_ops < min_text_ops and image_ops > 0
+
+
+# Function to save a PIL image or raw bytes as JPEG through one large write
+# buffer, instead of flushing to disk for every encoder block
+def save_image(image, path):
+    with open(path, "wb", buffering=IMAGE_BUFFER_SIZE) as f:
+        if isinstance(image, bytes):
+            f.write(image)
+        else:
+            image.save(f, format="JPEG")
+
+
 def sort_bounding_boxes(objects, y_tolerance=5):
     # Sort by y1 first (top-to-bottom), then by x0 (left-to-right)
     return sorted(
@@ -64,32 +164,66 @@ def sort_bounding_boxes(objects, y_tolerance=5):
     )
 
 
-def extract_pdf_content(pdf_file, output_dir, args):
-
-    # Prepare output paths
-    images_folder = output_dir / "images"
-    images_folder.mkdir(exist_ok=True)
-
-    # Inidialize PDF handlers
-    pdf = open(pdf_file, "rb")
+# Function to open a PDF with pdfminer on a memory map, which workers share
+# through the page cache instead of each holding a copy of the file
+def open_pdf(pdf_file):
+    with open(pdf_file, "rb") as fp:
+        try:
+            pdf = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+        except (OSError, ValueError):
+            # Not mappable (e.g. some network filesystems), read it into memory
+            pdf = io.BytesIO(fp.read())
     parser = PDFParser(pdf)
     doc = PDFDocument(parser)
     parser.set_document(doc)
+    return pdf, doc
+
+
+# Function to rebuild a page from its object id without walking the page tree,
+# inheriting attributes from its parent nodes like PDFPage.create_pages does
+def load_page(doc, page_id):
+    attrs = dict_value(doc.getobj(page_id)).copy()
+    parent = attrs.get("Parent")
+    visited = {page_id}
+    while isinstance(parent, PDFObjRef) and parent.objid not in visited:
+        visited.add(parent.objid)
+        parent_attrs = dict_value(parent)
+        for key in PDFPage.INHERITABLE_ATTRS:
+            if key not in attrs and key in parent_attrs:
+                attrs[key] = parent_attrs[key]
+        parent = parent_attrs.get("Parent")
+    return PDFPage(doc, page_id, attrs, None)
+
+
+def extract_page_range(pdf_file, images_folder, cluster_margin, skip_scans, laparams_profile, page_ids):
+    # pdfminer objects are not picklable, so every worker opens its own handlers
+    # and gets (page_num, page_id) pairs for its range
+    # Inidialize PDF handlers
+    pdf, doc = open_pdf(pdf_file)
     rsrcmgr = PDFResourceManager()
-    laparams = LAParams()
+    laparams = LAPARAMS_PROFILES[laparams_profile]
     device = PDFPageAggregator(rsrcmgr, laparams=laparams)
     interpreter = PDFPageInterpreter(rsrcmgr, device)
     pymupdf_doc = pymupdf.open(pdf_file)
 
     result = []
-    for page_num, page in enumerate(PDFPage.create_pages(doc)):
+    for page_num, page_id in page_ids:
+        page = load_page(doc, page_id)
         # Get layout
         page_image = convert_from_path(
             pdf_file,
-            first_page=page_num,
+            first_page=page_num + 1,
             last_page=page_num + 1,
             size=(page.mediabox[2], page.mediabox[3]),
         )[0]
+
+        # Scans have no text to lay out, keep the whole page as a single image
+        if skip_scans and is_scanned_page(page):
+            image_name = f"image_page-{page_num}_im-0.jpg"
+            save_image(page_image, images_folder / image_name)
+            result.append({"page": page_num + 1, "content": f"<image>{image_name}</image>"})
+            continue
+
         interpreter.process_page(page)
         layout = device.get_result()
 
@@ -99,7 +233,7 @@ def extract_pdf_content(pdf_file, output_dir, args):
         tables = [Table(table.bbox) for table in pymupdf_doc[page_num].find_tables()]
 
         if figures:
-            clustered_figures = cluster_figures(figures, eps=args.cluster_margin)
+            clustered_figures = cluster_figures(figures, eps=cluster_margin)
             lt_objs = [element for element in lt_objs if element not in figures]
             for figure in clustered_figures:
                 lt_objs.append(figure)
@@ -108,6 +242,14 @@ def extract_pdf_content(pdf_file, output_dir, args):
                 lt_objs.append(table)
         sorted_lt = sort_bounding_boxes(lt_objs)
 
+        # Element boxes in pdfminer coordinates, pymupdf tables have a top-left origin
+        page_top = layout.bbox[3]
+        layout_bboxes = [
+            (obj.bbox[0], page_top - obj.bbox[3], obj.bbox[2], page_top - obj.bbox[1])
+            if isinstance(obj, Table) else obj.bbox
+            for obj in sorted_lt
+        ]
+
         # Create output layout
         page_content = []
         for t, element in enumerate(sorted_lt):
@@ -117,11 +259,22 @@ def extract_pdf_content(pdf_file, output_dir, args):
             if isinstance(element, Figure):
                 image_name = f"image_page-{page_num}_im-{t}.jpg"
                 page_content.append(f"<image>{image_name}</image>")
+
+                # Write embedded JPEGs as-is instead of re-encoding a page crop
+                try:
+                    other_bboxes = [bbox for obj, bbox in zip(sorted_lt, layout_bboxes) if obj is not element]
+                    jpeg_data = get_jpeg_data(element, other_bboxes)
+                except Exception:
+                    jpeg_data = None
+                if jpeg_data:
+                    save_image(jpeg_data, images_folder / image_name)
+                    continue
+
                 x0, y0, x1, y1 = element.bbox
                 image_height = page_image.height
                 crop_box = (x0, image_height - y1, x1, image_height - y0)
                 cropped_image = page_image.crop(crop_box)
-                cropped_image.save(images_folder / image_name)
+                save_image(cropped_image, images_folder / image_name)
 
             if isinstance(element, Table):
                 table_name = f"table_page-{page_num}_im-{t}.jpg"
@@ -131,24 +284,68 @@ def extract_pdf_content(pdf_file, output_dir, args):
 
         page_content = " ".join(page_content)
         result.append({"page": page_num + 1, "content": page_content})
+    pdf.close()
     return result
 
 
+def iter_pdf_content(pdf_file, output_dir, args):
+
+    # Prepare output paths
+    images_folder = output_dir / "images"
+    images_folder.mkdir(exist_ok=True)
+
+    # Walk the page tree once, workers rebuild their pages from the object ids
+    pdf, doc = open_pdf(pdf_file)
+    page_ids = list(enumerate(page.pageid for page in PDFPage.create_pages(doc)))
+    pdf.close()
+
+    # Split pages into contiguous ranges, ~1.5 ranges per worker to balance load
+    num_pages = len(page_ids)
+    num_workers = args.num_workers or os.cpu_count()
+    chunk_size = max(1, math.ceil(num_pages / (num_workers * 1.5)))
+    page_ranges = [
+        page_ids[start : start + chunk_size] for start in range(0, num_pages, chunk_size)
+    ]
+    worker = functools.partial(
+        extract_page_range,
+        pdf_file,
+        images_folder,
+        args.cluster_margin,
+        args.skip_scans,
+        args.laparams_profile,
+    )
+
+    # Yield pages in order as soon as their range is done, so only the
+    # in-flight ranges are held in memory
+    with Pool(num_workers) as pool:
+        for pages_content in pool.imap(worker, page_ranges):
+            yield from pages_content
+
+
+def extract_pdf_content(pdf_file, output_dir, args):
+    return list(iter_pdf_content(pdf_file, output_dir, args))
+
+
 def main():
     args = parse_args()
     pdf_file = Path(args.pdf_path)
 
     # Prepare output paths
-    if output_dir is None:
+    if args.output_dir is None:
         output_dir = pdf_file.parent / pdf_file.stem
     else:
         output_dir = Path(args.output_dir)
     output_dir.mkdir(exist_ok=True)
 
-    content = extract_pdf_content(pdf_file, output_dir, args)
+    # Write each page as it is extracted, keeping the json.dump(indent=4) layout
     output_file = Path(output_dir) / "document_content.json"
     with open(output_file, "w", encoding="utf-8") as json_file:
-        json.dump(content, json_file, ensure_ascii=False, indent=4)
+        json_file.write("[")
+        for page_num, page_content in enumerate(iter_pdf_content(pdf_file, output_dir, args)):
+            page_json = json.dumps(page_content, ensure_ascii=False, indent=4)
+            json_file.write(",\n" if page_num else "\n")
+            json_file.write(textwrap.indent(page_json, " " * 4))
+        json_file.write("\n]")
 
 
 def parse_args():
@@ -171,6 +368,24 @@ def parse_args():
         default=50,
         help="Marging for the clustering algorithm",
     )
+    parser.add_argument(
+        "--num_workers",
+        type=int,
+        default=None,
+        help="Number of worker processes (defaults to the CPU count)",
+    )
+    parser.add_argument(
+        "--skip_scans",
+        action="store_true",
+        help="Skip layout analysis on scanned (image-only) pages",
+    )
+    parser.add_argument(
+        "--laparams_profile",
+        type=str,
+        choices=list(LAPARAMS_PROFILES),
+        default="fast",
+        help="Layout analysis settings, fast skips pdfminer's text box grouping (boxes_flow=None)",
+    )
     args = parser.parse_args()
     return args
 
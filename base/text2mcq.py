@@ -10,6 +10,8 @@ from openai import (
 )
 from tqdm import tqdm
 import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 from os import listdir
 from os.path import isfile, join
 import os
@@ -61,6 +63,24 @@ def chat_completion(
             continue
 
 
+def extract_mcq(client, parsed_text):
+    prompt = "{}\n\n{}".format(pre_prompt, parsed_text)
+    response, _ = chat_completion(
+        client,
+        [{"role": "user", "content": prompt.strip()}],
+        model="gpt-4o",
+        return_text=True,
+        return_usage=True,
+        model_args={
+            "temperature": 0.0,
+            "max_tokens": 4096,
+            "frequency_penalty": 0,
+            "presence_penalty": 0,
+        },
+    )
+    return response
+
+
 def parse_gpt_output(q):
     parts = q.split("\n")
     try:
@@ -96,7 +116,7 @@ def parse_gpt_output(q):
     return question, choice_1, choice_2, choice_3, choice_4, choice_5
 
 
-def main(dir_path, openai_key):
+def main(dir_path, openai_key, num_workers=10):
     client = OpenAI(api_key=openai_key)
 
     dir_path_parsed = dir_path + "/parsed"
@@ -112,21 +132,17 @@ def main(dir_path, openai_key):
 
         results = list()
         print(len(pages))
-        for _, row in tqdm(pages.iterrows()):
-            prompt = "{}\n\n{}".format(pre_prompt, row["parsed_text"])
-            response, _ = chat_completion(
-                client,
-                [{"role": "user", "content": prompt.strip()}],
-                model="gpt-4o",
-                return_text=True,
-                return_usage=True,
-                model_args={
-                    "temperature": 0.0,
-                    "max_tokens": 4096,
-                    "frequency_penalty": 0,
-                    "presence_penalty": 0,
-                },
+
+        # Requests are network bound, keep up to num_workers of them in flight
+        with ThreadPoolExecutor(max_workers=num_workers) as executor:
+            responses = list(
+                tqdm(
+                    executor.map(partial(extract_mcq, client), pages["parsed_text"]),
+                    total=len(pages),
+                )
             )
+
+        for (_, row), response in zip(pages.iterrows(), responses):
             row["output"] = response
 
             for q in response.split("\n\n"):
@@ -176,5 +192,7 @@ if __name__ == "__main__":
 
     parser.add_argument("-k", "--key", help="", default="")
 
+    parser.add_argument("-w", "--workers", help="Concurrent requests", type=int, default=10)
+
     args = parser.parse_args()
-    main(dir_path=args.dir, client=args.key)
+    main(dir_path=args.dir, openai_key=args.key, num_workers=args.workers)
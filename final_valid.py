@@ -1,25 +1,66 @@
 import pandas as pd
 import json
+import ijson
+import orjson
 import os
 import argparse
 from collections import defaultdict
-from huggingface_hub import HfApi, HfFolder, Repository
+from huggingface_hub import HfFolder, Repository
 from huggingface_hub import hf_hub_download
 from huggingface_hub import snapshot_download
 
 from rich.console import Console
 from rich.table import Table
 import shutil
+import time
+from concurrent.futures import ThreadPoolExecutor
 
+SHEET_CACHE_TTL = 3600
 
-def main(local_dir):
-  api = HfApi()
+
+def print_categories(json_path, entries):
+  # Get category_en, category_original_lang and print set
+  cats_en = set()
+  cats_original = set()
+  image_png = set()
+  image_information = set()
+  
+  for item in entries:
+    cats_en.add(item["category_en"])
+    cats_original.add(item["category_original_lang"])
+    image_information.add(item["image_information"])
+    image_png.add(item["image_type"])
+  print(json_path)
+  print(f"Category_en: {cats_en}")
+  print(f"Category_original_lang: {cats_original}")
+  print(f"Image information: {image_information}")
+  print(f"Image type: {image_png}")
+  print("-"*80)
+
+
+def download_repo(repo, save_dir):
+  try:
+    snapshot_download(repo_id=repo, repo_type="dataset", 
+                    local_dir=save_dir, max_workers=8)
+  except:
+    # Access issue
+    print( f"Access issue with {repo}")
+
+
+def main(local_dir, num_workers=4, refresh_sheet=False):
 
   sheet = "Completed_and_Validated_Exams"
   gsheet_id = "1f4nkmFyTaYu0-iBeRQ1D-KTD3JoyC-FI7V9G6hTdn5o"
   data_url = f"https://docs.google.com/spreadsheets/d/{gsheet_id}/gviz/tq?tqx=out:csv&sheet={sheet}"
 
-  df = pd.read_csv(data_url)
+  # Reuse the sheet downloaded within the last hour unless asked to refresh
+  sheet_cache = os.path.join(local_dir, "_sheet.csv")
+  if not refresh_sheet and os.path.exists(sheet_cache) and time.time() - os.path.getmtime(sheet_cache) < SHEET_CACHE_TTL:
+    df = pd.read_csv(sheet_cache)
+  else:
+    df = pd.read_csv(data_url)
+    os.makedirs(local_dir, exist_ok=True)
+    df.to_csv(sheet_cache, index=False)
   HF_column = 'HF Dataset Link'
   hf_links = df[HF_column].dropna().tolist()
   print(hf_links)
@@ -37,6 +78,7 @@ def main(local_dir):
   grand_total = grand_text = grand_multimodal = 0
   
   visited = defaultdict(bool)
+  repos, save_dirs = [], []
   for idx, link in enumerate(hf_links):
     # break
     if visited[link]:
@@ -52,18 +94,16 @@ def main(local_dir):
     repo_user = link.split("/")[-2]
     repo_id = link.split("/")[-1]
     repo = f"{repo_user}/{repo_id}"
-    repo_files = api.list_repo_files(repo, repo_type="dataset")
-    # Download full repo from hub
     
     save_dir = os.path.join(local_dir, f"{idx:03d}__"+ repo.replace("/", "__"))
     # old_save_dir = os.path.join(local_dir, repo.replace("/", "__"))
     # shutil.move(old_save_dir, save_dir)
-    try:
-      snapshot_download(repo_id=repo, repo_type="dataset", 
-                      local_dir=save_dir, max_workers=8)
-    except:
-      # Access issue
-      print( f"Access issue with {repo}")
+    repos.append(repo)
+    save_dirs.append(save_dir)
+  
+  # Download full repos from hub, several repos at a time
+  with ThreadPoolExecutor(max_workers=num_workers) as executor:
+    list(executor.map(download_repo, repos, save_dirs))
   
   # For all json files in the local_dir open and save as indent=2, ensure ascii=False
   
@@ -77,30 +117,18 @@ def main(local_dir):
         if file.startswith("valid__"):
           continue
         
-        with open(os.path.join(root, file), "r", encoding="utf-8") as f:
-          data = json.load(f)
-          # Get category_en, category_original_lang and print set
-          cats_en = set()
-          cats_original = set()
-          image_png = set()
-          image_information = set()
-          
-          for item in data:
-            cats_en.add(item["category_en"])
-            cats_original.add(item["category_original_lang"])
-            image_information.add(item["image_information"])
-            image_png.add(item["image_type"])
-          print(os.path.join(root, file))
-          print(f"Category_en: {cats_en}")
-          print(f"Category_original_lang: {cats_original}")
-          print(f"Image information: {image_information}")
-          print(f"Image type: {image_png}")
-          print("-"*80)
-        
+        json_path = os.path.join(root, file)
         if os.path.exists(valid_file):
+          # Already exported, stream the entries instead of loading the whole file
+          with open(json_path, "rb") as f:
+            print_categories(json_path, ijson.items(f, "item"))
           continue
         
-        with open(os.path.join(root, "valid__" + file), "w", encoding="utf-8") as f:
+        with open(json_path, "rb") as f:
+          data = orjson.loads(f.read())
+        print_categories(json_path, data)
+        
+        with open(valid_file, "w", encoding="utf-8") as f:
           json.dump(data, f, indent=2, ensure_ascii=False)
   
   # find . -type f -name "*.zip" -exec sh -c 'unzip -d "${1%.*}" "$1"' _ {} \;
@@ -110,6 +138,8 @@ def main(local_dir):
 if __name__ == "__main__":
   parser = argparse.ArgumentParser()
   parser.add_argument("--local_dir", type=str, default="./a_final_validation")
+  parser.add_argument("--num_workers", type=int, default=4, help="Repos downloaded in parallel")
+  parser.add_argument("--refresh_sheet", action="store_true", help="Ignore the cached Google Sheet")
   args = parser.parse_args()
   local_dir = args.local_dir
-  main(local_dir)
+  main(local_dir, args.num_workers, args.refresh_sheet)
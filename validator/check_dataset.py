@@ -1,21 +1,30 @@
 # Cohere For AI Community, Danylo Boiko, 2024
 
 import os
-import json
+import sys
 import argparse
+import hashlib
 
-from typing import Union, Literal, Optional
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+from typing import TYPE_CHECKING, Any, Literal, Optional
 
-from pydantic import BaseModel, ValidationError, field_validator, model_validator
+import orjson
+from pydantic import BaseModel, TypeAdapter, ValidationError, field_validator, model_validator
 from pydantic_core.core_schema import ValidationInfo
 from rich.console import Console
-from rich.panel import Panel
-from rich.syntax import Syntax
 from rich.text import Text
-from rich.tree import Tree
+
+if TYPE_CHECKING:
+    from rich.tree import Tree
 
 
 MIN_OPTIONS_COUNT = 2
+VALIDATION_BATCH_SIZE = 1000
+INTERNED_FIELDS = (
+    "language", "country", "file_name", "source", "license", "level", "category_en", "category_original_lang"
+)
 
 
 class EntrySchema(BaseModel):
@@ -27,7 +36,7 @@ class EntrySchema(BaseModel):
     level: str
     category_en: str
     category_original_lang: str
-    original_question_num: Union[int, str]
+    original_question_num: str
     question: str
     options: list[str]
     answer: int
@@ -38,6 +47,10 @@ class EntrySchema(BaseModel):
 
     @staticmethod
     def _validate_string(value: str) -> str:
+        # Fast path for well-formed values, a non-whitespace first character already guarantees a non-empty strip()
+        if value and value[-1] != " " and not value[0].isspace():
+            return value
+
         if not value.strip():
             raise ValueError("Value cannot be empty or whitespace")
 
@@ -65,6 +78,18 @@ class EntrySchema(BaseModel):
 
         return cls._validate_string(language)
 
+    @field_validator("original_question_num", mode="before")
+    def validate_original_question_num(cls, original_question_num: Any) -> Any:
+        # Numbers are stored as strings, a single type check instead of an int/str union.
+        # Bools count as numbers, as they did under the union (True -> "1")
+        if isinstance(original_question_num, int):
+            return str(int(original_question_num))
+
+        if isinstance(original_question_num, float) and original_question_num.is_integer():
+            return str(int(original_question_num))
+
+        return original_question_num
+
     @field_validator("options")
     def validate_options(cls, options: list[str], config: ValidationInfo) -> list[str]:
         for option in options:
@@ -118,9 +143,14 @@ class EntrySchema(BaseModel):
 
     @model_validator(mode="after")
     def validate_image_data(cls, model: "EntrySchema") -> "EntrySchema":
-        image_data = [model.image_png, model.image_information, model.image_type]
-
-        if any(image_data) and not all(image_data):
+        # One bit per image field, either none or all three (0b111) must be specified
+        image_data = (
+            (model.image_png is not None)
+            | (model.image_information is not None) << 1
+            | (model.image_type is not None) << 2
+        )
+
+        if image_data not in (0, 0b111):
             raise ValueError(
                 "All fields related to image data (prefixed with 'image_') must be specified if any one of them is specified"
             )
@@ -131,7 +161,23 @@ class EntrySchema(BaseModel):
         extra = "forbid"
 
 
+ENTRIES_ADAPTER = TypeAdapter(list[EntrySchema])
+
+
+def validate_batch(entries: list[dict], start: int, context: dict) -> list[tuple[int, str, tuple]]:
+    # Validate a batch in a single pydantic-core call, the index within the batch leads each error location.
+    # Errors are returned as plain (index, message, location) tuples so they can be sent back from worker processes
+    try:
+        ENTRIES_ADAPTER.validate_python(entries, context=context)
+    except ValidationError as e:
+        return [(start + error["loc"][0], error.get("msg"), tuple(error["loc"][1:])) for error in e.errors()]
+
+    return []
+
+
 class EntryError:
+    __slots__ = ("index", "message", "location")
+
     def __init__(self, index: int, message: str, location: Optional[tuple] = None) -> None:
         self.index = index
         self.message = message
@@ -148,8 +194,15 @@ class EntryError:
 
 
 class DatasetValidator:
-    def __init__(self, json_file: str, language_code: str) -> None:
+    def __init__(
+        self, json_file: str, language_code: str, workers: int = 1, quiet: bool = False, use_cache: bool = False
+    ) -> None:
         self.json_file: str = json_file
+        self.workers: int = workers
+        self.quiet: bool = quiet
+        self.use_cache: bool = use_cache
+        self.cache_file: str = f"{json_file}.validated"
+        self.cache_key: Optional[str] = None
         self.json_entries: list[dict] = []
         self.language_code: str = language_code.lower()
         self.images_path: str = os.path.join(os.path.dirname(json_file), "images")
@@ -157,69 +210,156 @@ class DatasetValidator:
         self.errors: list[EntryError] = []
 
     def validate(self) -> None:
-        self.console.print("Starting validation...", style="green")
-        self.console.print(f"JSON file: {self.json_file}", style="cyan")
-        self.console.print(f"Images path: {self.images_path}", style="cyan")
-        self.console.print(f"Language code: {self.language_code}", style="cyan")
+        if not self.quiet:
+            self.console.print("Starting validation...", style="green")
+            self.console.print(f"JSON file: {self.json_file}", style="cyan")
+            self.console.print(f"Images path: {self.images_path}", style="cyan")
+            self.console.print(f"Language code: {self.language_code}", style="cyan")
+
+        data = self._read_json()
+        if data is None:
+            return
 
-        if not self._load_json():
+        # Check the cache on the raw bytes, so a hit never parses the file
+        if self.use_cache:
+            self.cache_key = self._compute_cache_key(data)
+            if self._is_cached():
+                if not self.quiet:
+                    self.console.print("The JSON file is unchanged since its last successful validation", style="green")
+                return
+
+        if not self._load_json(data):
             return
 
         self._validate_entries()
         self._print_validation_report()
 
-    def _load_json(self) -> bool:
+        if self.use_cache and len(self.errors) == 0:
+            self._write_cache()
+
+    def _read_json(self) -> Optional[bytes]:
+        try:
+            with open(self.json_file, "rb") as file:
+                return file.read()
+        except Exception as e:
+            self.console.print(f"Error loading file {self.json_file}: {e}", style="red")
+            return None
+
+    def _load_json(self, data: bytes) -> bool:
         try:
-            with open(self.json_file, "r", encoding="utf-8") as file:
-                entries = json.load(file)
+            entries = orjson.loads(data)
 
-                if not isinstance(entries, list):
-                    raise ValueError("The file must contain a JSON array (list of entries)")
+            if not isinstance(entries, list):
+                raise ValueError("The file must contain a JSON array (list of entries)")
 
-                self.json_entries = entries
+            # Metadata values repeat across the entries, keep a single copy of each
+            for entry in entries:
+                if isinstance(entry, dict):
+                    for field in INTERNED_FIELDS:
+                        value = entry.get(field)
+                        if isinstance(value, str):
+                            entry[field] = sys.intern(value)
+
+            self.json_entries = entries
             return True
         except Exception as e:
             self.console.print(f"Error loading file {self.json_file}: {e}", style="red")
             return False
 
+    def _compute_cache_key(self, data: bytes) -> str:
+        # Besides the file itself, the result depends on the language, the images on disk and the schema
+        key = hashlib.blake2b(data)
+        key.update(self.language_code.encode())
+
+        if os.path.isdir(self.images_path):
+            key.update("\n".join(sorted(os.listdir(self.images_path))).encode())
+
+        with open(__file__, "rb") as file:
+            key.update(file.read())
+
+        return key.hexdigest()
+
+    def _is_cached(self) -> bool:
+        try:
+            with open(self.cache_file, "r", encoding="utf-8") as file:
+                return file.read().strip() == self.cache_key
+        except OSError:
+            return False
+
+    def _write_cache(self) -> None:
+        try:
+            with open(self.cache_file, "w", encoding="utf-8") as file:
+                file.write(self.cache_key)
+        except OSError as e:
+            self.console.print(f"Could not write the validation cache {self.cache_file}: {e}", style="yellow")
+
     def _validate_entries(self) -> None:
+        entry_errors = defaultdict(list)
+        context = {
+            "dataset_language": self.language_code,
+            "images_path": self.images_path,
+        }
+
+        # Validate the entries batch by batch, so only one batch of models is alive at a time per process
+        starts = range(0, len(self.json_entries), VALIDATION_BATCH_SIZE)
+        batches = (self.json_entries[start:start + VALIDATION_BATCH_SIZE] for start in starts)
+
+        if self.workers > 1:
+            with ProcessPoolExecutor(max_workers=self.workers) as executor:
+                batch_errors = list(executor.map(validate_batch, batches, starts, repeat(context)))
+        else:
+            batch_errors = list(map(validate_batch, batches, starts, repeat(context)))
+
+        for errors in batch_errors:
+            for index, message, location in errors:
+                entry_errors[index].append(EntryError(index, message, location))
+
         seen_entries = {}
 
         for index, entry in enumerate(self.json_entries):
-            try:
-                entry_model = EntrySchema.model_validate(entry, context={
-                    "dataset_language": self.language_code,
-                    "images_path": self.images_path,
-                })
-
-                entry_hash = (entry_model.question, entry_model.image_png, tuple(opt for opt in entry_model.options))
-
-                if entry_hash not in seen_entries:
-                    seen_entries[entry_hash] = index
-                else:
-                    self.errors.append(EntryError(index, f"Duplicate of entry with index {seen_entries[entry_hash]}"))
-            except ValidationError as e:
-                self.errors.extend([
-                    EntryError(index, error.get("msg"), error.get("loc", None)) for error in e.errors()
-                ])
+            if index in entry_errors:
+                self.errors.extend(entry_errors[index])
+                continue
+
+            entry_hash = (entry["question"], entry["image_png"], tuple(opt for opt in entry["options"]))
+
+            if entry_hash not in seen_entries:
+                seen_entries[entry_hash] = index
+            else:
+                self.errors.append(EntryError(index, f"Duplicate of entry with index {seen_entries[entry_hash]}"))
 
     def _print_validation_report(self) -> None:
         if len(self.errors) == 0:
-            return self.console.print("Congratulations, the JSON file is valid!", style="green")
+            if not self.quiet:
+                self.console.print("Congratulations, the JSON file is valid!", style="green")
+            return
+
+        # Only needed to render errors, so a valid file never imports them
+        from rich.panel import Panel
 
         self.console.print("The following errors were found, fix them and try again:", style="red")
 
+        # Render each entry once, listing all of its errors
+        errors_by_index = defaultdict(list)
         for error in self.errors:
-            self.console.print(Panel(self._create_error_tree(error), expand=False, border_style="red"))
+            errors_by_index[error.index].append(error)
+
+        for index, errors in errors_by_index.items():
+            self.console.print(Panel(self._create_error_tree(index, errors), expand=False, border_style="red"))
 
-    def _create_error_tree(self, error: EntryError) -> Tree:
-        entry = self.json_entries[error.index]
+    def _create_error_tree(self, index: int, errors: list[EntryError]) -> "Tree":
+        from rich.tree import Tree
 
-        tree = Tree(f"Error in entry with index {error.index}", style="red")
-        tree.add(Text(str(error), style="yellow"))
+        entry = self.json_entries[index]
+        if not isinstance(entry, dict):
+            entry = {}
+
+        tree = Tree(f"Error in entry with index {index}", style="red")
+        for error in errors:
+            tree.add(Text(str(error), style="yellow"))
 
         question_node = tree.add("Question")
-        question_node.add(Syntax(entry.get("question", "N/A"), "text", word_wrap=True))
+        question_node.add(Text(str(entry.get("question", "N/A"))))
 
         options_node = tree.add("Options")
         for option_num, option_value in enumerate(entry.get("options", []), 1):
@@ -235,7 +375,14 @@ if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument("--json_file", type=str, required=True, help="Path to the JSON file to be validated")
     parser.add_argument("--language_code", type=str, required=True, help="The language code for the dataset")
+    parser.add_argument("--workers", type=int, default=1, help="Number of processes used to validate the entries")
+    parser.add_argument("--quiet", action="store_true", help="Only print output if the file is invalid")
+    parser.add_argument(
+        "--cache",
+        action="store_true",
+        help="Skip validation if the file passed unchanged before; writes <json_file>.validated",
+    )
     args = parser.parse_args()
 
-    validator = DatasetValidator(args.json_file, args.language_code)
+    validator = DatasetValidator(args.json_file, args.language_code, args.workers, args.quiet, args.cache)
     validator.validate()